@@ -6,16 +6,22 @@ if TYPE_CHECKING:
     from collections.abc import Sequence, Iterable
     from numpy.typing import ArrayLike
 
-import json
+import math
+import numbers
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import mlflow
 import numpy as np
 import pandas as pd
+from mlflow.entities import Metric, Param, RunTag
 from mlflow.tracking import MlflowClient
 from mlflow.utils.mlflow_tags import MLFLOW_PARENT_RUN_ID, MLFLOW_RUN_NAME
 from ray import tune
 from ray.tune.search.sample import Categorical, Domain, Quantized
 from sklearn.model_selection import ParameterGrid, train_test_split
+from sklearn.utils import check_random_state
 
 from . import pyutils as pu
 
@@ -23,9 +29,9 @@ from . import pyutils as pu
 def cv_results_df(cv_results, result_cols=None):
     if result_cols is None:
         result_cols = ["mean_test_score"]
-    res = pd.DataFrame(cv_results)
-    param_cols = [col for col in res.columns if col.startswith("param_")]
-    ret = res[param_cols + result_cols].sort_values(result_cols[0], ascending=False)
+    param_cols = [col for col in cv_results if col.startswith("param_")]
+    res = pd.DataFrame({col: cv_results[col] for col in param_cols + result_cols})
+    ret = res.sort_values(result_cols[0], ascending=False)
 
     return ret
 
@@ -38,12 +44,27 @@ def stratified_data_subset(X, y, size_ratio=0.2, random_state=None):
     return X_subset, y_subset
 
 
-def subset_indices(arr, ratio=0.2, random_state=0, **train_test_split_kwargs):
+def subset_indices(
+    arr, ratio=0.2, random_state=0, stratify=True, **train_test_split_kwargs
+):
+    # stratify is True (stratify by arr), custom labels, or None/False
+    if stratify is True:
+        stratify = arr
+    elif stratify is False:
+        stratify = None
     index = range(arr.shape[0])
+    if stratify is None and not train_test_split_kwargs:
+        # same subset size as train_test_split's test_size, without its overhead
+        n = len(index)
+        k = ratio if isinstance(ratio, numbers.Integral) else math.ceil(ratio * n)
+        if not 0 < k < n:
+            raise ValueError(f"ratio={ratio} leaves an empty subset of {n} samples")
+        return check_random_state(random_state).permutation(n)[:k].tolist()
+
     index_train, index_test = train_test_split(
         index,
         test_size=ratio,
-        stratify=arr,
+        stratify=stratify,
         random_state=random_state,
         **train_test_split_kwargs,
     )
@@ -53,12 +74,12 @@ def subset_indices(arr, ratio=0.2, random_state=0, **train_test_split_kwargs):
 def data_subsets(
     X,
     y,
-    train_ratio: float | int | None = 0.8,
-    test_ratio: float | int | None = None,
-    val_ratio: float | int | None = None,
+    train_ratio: float | None = 0.8,
+    test_ratio: float | None = None,
+    val_ratio: float | None = None,
     ratio_factor: float = 1.0,
     random_state=None,
-    stratify=None,  # TODO use a custom array to stratify
+    stratify=None,
 ):
     ratios = []
     sets = []
@@ -75,48 +96,75 @@ def data_subsets(
         ratios.append(val_ratio)
         sets.append("val")
 
+    for s, r in zip(sets, ratios):
+        if not 0.0 < r <= 1.0:
+            raise ValueError(
+                f"The subset ratios must be fractions in (0, 1], got {s}={r}"
+            )
+
+    rng = check_random_state(random_state)
+    strata = np.asarray(y if stratify is None else stratify)
+    if sum(ratios) > 1.0 and not math.isclose(sum(ratios), 1.0):
+        raise ValueError(f"The subset ratios {ratios} sum to more than 1")
+
+    # group the row indices by class once
+    classes, class_idx = np.unique(strata, return_inverse=True)
+    order = np.argsort(class_idx, kind="stable")
+    class_starts = np.searchsorted(class_idx[order], np.arange(1, len(classes)))
+    buckets = np.split(order, class_starts)
+
+    # fix the overall subset sizes first (the last slot holds unused rows),
+    # then spread each subset over the classes still left, like train_test_split
+    weights = np.array(ratios + [max(1.0 - sum(ratios), 0.0)])
+    subset_sizes = _largest_remainder(weights, len(strata), rng)[:-1]
+    for s, size in zip(sets, subset_sizes):
+        if size == 0:
+            raise ValueError(
+                f"The {s} subset would be empty with {len(strata)} samples"
+            )
+
+    class_left = np.array([len(bucket) for bucket in buckets])
+    class_sizes = []
+    for size in subset_sizes:
+        class_sizes.append(_largest_remainder(class_left, size, rng))
+        class_left -= class_sizes[-1]
+    class_edges = np.cumsum([np.zeros_like(class_left)] + class_sizes, axis=0)
+
+    # shuffle each class once and cut it at its subset boundaries
+    split_indices: List[List[np.ndarray]] = [[] for _ in sets]
+    for bucket, edges in zip(buckets, class_edges.T):
+        bucket = rng.permutation(bucket)
+        for indices, lo, hi in zip(split_indices, edges[:-1], edges[1:]):
+            indices.append(bucket[lo:hi])
+
     data = {}
+    for s, indices in zip(sets, split_indices):
+        index = rng.permutation(np.concatenate(indices))
+        data["X_" + s] = _take_rows(X, index)
+        data["y_" + s] = _take_rows(y, index)
 
-    num_classes = len(np.unique(y))
-
-    X_left, y_left, ratio_left, ratio_used = X, y, 1.0, 1.0
-    for r, s in zip(ratios, sets):
-        stratify = y_left
-        r_adjusted = r / ratio_left
-        num_left_examples = (1.0 - r_adjusted) * len(X_left)
-        if r_adjusted >= 1.0 or num_left_examples < num_classes:
-            print("Re-adjusting r", r_adjusted)
-            print(f"{num_left_examples=}")
-            r_adjusted = num_classes
-
-        # alternative way if no indices are needed
-        X_train, X_left, y_train, y_left = train_test_split(
-            X_left,
-            y_left,
-            train_size=r_adjusted,
-            stratify=stratify,
-            random_state=random_state,
-        )
+    return data
 
-        # sss = StratifiedShuffleSplit(
-        #     n_splits=1, train_size=r / ratio_left, random_state=random_state
-        # )
-        # index_train, index_left = next(sss.split(X_left, y_left))
-        # X_train = X_left[index_train]
-        # y_train = y_left[index_train]
-        # X_left = X_left[index_left]
-        # y_left = y_left[index_left]
 
-        ratio_left = ratio_left - r
-        if r_adjusted >= 1.0:
-            X_train = np.concatenate([X_train, X_left])
-            y_train = np.concatenate([y_train, y_left])
+def _largest_remainder(weights, n_draws, rng):
+    # split n_draws proportionally to weights, handing the rows lost to flooring
+    # to the largest remainders (ties broken at random, as in sklearn's
+    # _approximate_mode)
+    continuous = weights * n_draws / weights.sum()
+    floored = np.floor(continuous).astype(int)
+    need = n_draws - floored.sum()
+    if need > 0:
+        remainder = continuous - floored
+        order = rng.permutation(len(weights))
+        order = order[np.argsort(-remainder[order], kind="stable")]
+        floored[order[:need]] += 1
+    return floored
 
-        # data["index_" + s] = index_train
-        data["X_" + s] = X_train
-        data["y_" + s] = y_train
 
-    return data
+def _take_rows(arr, index):
+    if hasattr(arr, "iloc"):
+        return arr.iloc[index]
+    return np.asarray(arr)[index]
 
 
 def plot_class_distributions(
@@ -126,13 +174,10 @@ def plot_class_distributions(
 ) -> None:
     dists = []
     for i, arr in enumerate(arrs):
-        arr_series = pd.Series(arr, name=names[i])
-        dist = arr_series.groupby(arr_series).count()
-        if perc:
-            dist = dist / dist.sum()
-        dists.append(dist)
+        dist = pd.Series(arr, name=names[i]).value_counts(normalize=perc)
+        dists.append(dist.sort_index())
 
-    pd.concat(dists, axis=1).plot.bar()
+    pd.concat(dists, axis=1).fillna(0).plot.bar()
 
 
 # plot_class_distributions(
@@ -147,6 +192,10 @@ RAY_MLFLOW_MIXIN_LOGGER = "ray-mlflow_mixin"
 
 MLFLOW_RUNGROUP_TAGNAME = "mlflow_rungroup"
 
+MLFLOW_MAX_WORKERS = 16
+
+_REGEX_METACHARS = re.compile(r"[.^$*+?{}\[\]\\|()]")
+
 
 def find_runs(
     run_name_contains=None,
@@ -155,23 +204,36 @@ def find_runs(
     **search_runs_kwargs,
 ):
     df = mlflow.search_runs(**search_runs_kwargs)
+    if len(df) == 0:
+        return df
+
+    mask = np.ones(len(df), dtype=bool)
 
     col = f"tags.{MLFLOW_RUN_NAME}"
     if run_name_contains and (col in df.columns):
-        df = df[df[col].str.contains(run_name_contains)]
+        if _REGEX_METACHARS.search(run_name_contains):
+            pat, regex = re.compile(run_name_contains), True
+        else:
+            pat, regex = run_name_contains, False
+        mask &= df[col].str.contains(pat, regex=regex, na=False).to_numpy()
     # filter_string = f"tags.`{MLFLOW_RUN_NAME}` = '{run_name}'"
 
     col = f"tags.{MLFLOW_PARENT_RUN_ID}"
     if exclude_child_runs and (col in df.columns):
-        df = df[df[col].isna()]
+        mask &= df[col].isna().to_numpy()
 
     col = f"tags.{MLFLOW_RUNGROUP_TAGNAME}"
     if in_latest_run_group and (col in df.columns):
-        latest_run_group = df[col].sort_values(ascending=False).iloc[0]
-        df = df[df[col] == latest_run_group]
+        # runs without the tag (e.g. the summary run) come back as None
+        latest_run_group = df.loc[mask, col].dropna().max()
+        if pd.isna(latest_run_group):
+            return df.iloc[:0]
+        mask &= (df[col] == latest_run_group).to_numpy()
     # filter_string = f'tags.{MLFLOW_RUNGROUP_TAGNAME} = "{latest_run_group}"'
 
-    return df
+    if mask.all():
+        return df
+    return df.loc[mask]
 
 
 def assimilate_ray_runs(found_runs_df):
@@ -179,8 +241,9 @@ def assimilate_ray_runs(found_runs_df):
     RAY_MLFLOW_TRIAL_TAGNAME = "trial_name"
 
     df = found_runs_df
-    df_cback = df[df[f"tags.{MLFLOW_LOGGER_TAGNAME}"] == RAY_MLFLOW_CALLBACK_LOGGER]
-    df_mixin = df[~(df[f"tags.{MLFLOW_LOGGER_TAGNAME}"] == RAY_MLFLOW_CALLBACK_LOGGER)]
+    is_cback = df[f"tags.{MLFLOW_LOGGER_TAGNAME}"] == RAY_MLFLOW_CALLBACK_LOGGER
+    df_cback = df[is_cback]
+    df_mixin = df[~is_cback]
     # df_mixin = df[
     #     df[f"tags.{MLFLOW_LOGGER_TAGNAME}"] == RAY_MLFLOW_MIXIN_LOGGER
     # ]
@@ -190,28 +253,46 @@ def assimilate_ray_runs(found_runs_df):
     # print(f"{mixin_run_ids=}")
     # print(f"{cback_run_ids=}")
 
-    for mixin_run_id, cback_run_id in zip(mixin_run_ids, cback_run_ids):
-        mixin_run = mlflow.get_run(mixin_run_id)
-        cback_run = mlflow.get_run(cback_run_id)
-
-        with mlflow.start_run(run_id=mixin_run_id) as combined_run:
-            mlflow.log_metrics(pu.prefix_dict_keys(cback_run.data.metrics, "ray_"))
+    client = MlflowClient()
+    timestamp = int(time.time() * 1000)
+
+    def _assimilate_one(run_ids):
+        mixin_run_id, cback_run_id = run_ids
+        cback_run = client.get_run(cback_run_id)
+
+        metrics = [
+            Metric(key, val, timestamp, 0)
+            for key, val in pu.prefix_str_dict_keys(
+                cback_run.data.metrics, "ray_"
+            ).items()
+        ]
+        params = [
+            Param(key, val)
+            for key, val in pu.prefix_str_dict_keys(
+                cback_run.data.params, "ray_conf_"
+            ).items()
+        ]
+
+        tags_to_set = {
+            k: v
+            for k, v in cback_run.data.tags.items()
+            if k
+            in {
+                MLFLOW_RUNGROUP_TAGNAME,
+                RAY_MLFLOW_TRIAL_TAGNAME,
+                MLFLOW_RUN_NAME,
+            }
+        }
+        tags_to_set[MLFLOW_LOGGER_TAGNAME] = RAY_MLFLOW_MASTOR_LOGGER
+        # tags_to_set[MLFLOW_RUN_NAME]=mixin_run_id
+        tags = [RunTag(key, val) for key, val in tags_to_set.items()]
 
-            mlflow.log_params(pu.prefix_dict_keys(cback_run.data.params, "ray_conf_"))
+        client.log_batch(mixin_run_id, metrics=metrics, params=params, tags=tags)
 
-            tags_to_set = {
-                k: v
-                for k, v in cback_run.data.tags.items()
-                if k
-                in {
-                    MLFLOW_RUNGROUP_TAGNAME,
-                    RAY_MLFLOW_TRIAL_TAGNAME,
-                    MLFLOW_RUN_NAME,
-                }
-            }
-            tags_to_set[MLFLOW_LOGGER_TAGNAME] = RAY_MLFLOW_MASTOR_LOGGER
-            # tags_to_set[MLFLOW_RUN_NAME]=mixin_run_id
-            mlflow.set_tags(tags_to_set)
+    # mixin runs only carry the tags given to setup_mlflow, so there is no trial
+    # key to join on and runs are paired by their (start time) position
+    with ThreadPoolExecutor(max_workers=MLFLOW_MAX_WORKERS) as executor:
+        list(executor.map(_assimilate_one, zip(mixin_run_ids, cback_run_ids)))
 
     return mixin_run_ids, cback_run_ids
 
@@ -221,20 +302,23 @@ def create_tune_summary_run(config_space, run_name=""):
         run_name = "Ray Tune Rungroup Summary"
 
     config_space_dict = traverse_nested_tune_space(config_space)
-    config_space_json = json.dumps(config_space_dict, indent=4)
     with mlflow.start_run(run_name=run_name) as tune_summary_run:
         # mlflow.log_param("ray_conf", config_space_dict)
-        mlflow.log_dict(config_space_json, "config_space.json")
+        mlflow.log_dict(config_space_dict, "config_space.json")
     tune_summary_run_id = tune_summary_run.info.run_id
 
     return tune_summary_run_id
 
 
 def adopt_runs(children_run_ids, parent_run_id):
-    for run_id in children_run_ids:
+    client = MlflowClient()
+
+    def _adopt_one(run_id):
         print("Adopting run with id:", run_id)
-        with mlflow.start_run(run_id=run_id) as run:
-            mlflow.set_tag(f"{MLFLOW_PARENT_RUN_ID}", parent_run_id)
+        client.set_tag(run_id, MLFLOW_PARENT_RUN_ID, parent_run_id)
+
+    with ThreadPoolExecutor(max_workers=MLFLOW_MAX_WORKERS) as executor:
+        list(executor.map(_adopt_one, children_run_ids))
 
 
 def organize_latest_ray_runs(
@@ -302,79 +386,102 @@ def describe_as_dict(samfuncret: Domain):
     return desc
 
 
-def sample_tune_space(obj):
-    if isinstance(obj, dict):
-        new_obj = {}
-        for key in obj:
-            new_val = sample_tune_space(obj[key])
-            new_obj[key] = new_val
-
-        return new_obj
-    elif isinstance(obj, list):
-        new_obj = []
-        for el in obj:
-            new_el = sample_tune_space(el)
-            new_obj.append(new_el)
-
-        return new_obj
-
-    elif isinstance(obj, tuple):
-        new_obj_list = list(obj)
-        new_obj = tuple(sample_tune_space(new_obj_list))
-        return new_obj
-
-    elif isinstance(obj, Categorical):
-        sampled_obj = obj.sample()
-
-        return sample_tune_space(sampled_obj)
-
-    elif isinstance(obj, Domain):
-        sample = obj.sample()
-        return sample
-    else:
-        return obj
+class _TupleItems:
+    """Placeholder for a tuple whose items are still being filled in."""
 
+    __slots__ = ("items",)
 
-def traverse_nested_tune_space(obj, func=lambda x: print(x)):
-    if isinstance(obj, dict):
-        new_obj = {}
-        for key in obj:
-            new_val = traverse_nested_tune_space(obj[key])
-            new_obj[key] = new_val
+    def __init__(self, items):
+        self.items = items
 
-        return new_obj
 
-    elif isinstance(obj, list):
-        new_obj = []
-        for el in obj:
-            new_el = traverse_nested_tune_space(el)
-            new_obj.append(new_el)
+def _push_children(stack, children, new_container):
+    # reversed so that children are popped (and sampled) in their original order
+    stack.extend(reversed([(el, new_container, key) for key, el in children]))
 
-        return new_obj
 
-    elif isinstance(obj, tuple):
-        new_obj_list = list(obj)
-        new_obj = tuple(traverse_nested_tune_space(new_obj_list))
-        return new_obj
+def _expand_dict(stack, node, parent, key):
+    new_node = parent[key] = dict.fromkeys(node)
+    _push_children(stack, node.items(), new_node)
 
-    elif isinstance(obj, Categorical):
-        new_obj = {}
-        new_obj["sampler"] = "tune.choice"
 
-        new_el_list = []
-        for el in obj:
-            new_el = traverse_nested_tune_space(el)
-            new_el_list.append(new_el)
+def _expand_list(stack, node, parent, key):
+    new_node = parent[key] = [None] * len(node)
+    _push_children(stack, enumerate(node), new_node)
 
-        new_obj["categories"] = new_el_list
-        return new_obj
 
-    # a domain (other than Categorical)
-    elif isinstance(obj, Domain):
-        # obj_dict = {key:str(val) for key,val in obj.__dict__.items()}
-        obj_dict = describe_as_dict(obj)
+def _expand_tuple(stack, node, parent, key):
+    new_node = [None] * len(node)
+    stack.append((_TupleItems(new_node), parent, key))
+    _push_children(stack, enumerate(node), new_node)
 
-        return obj_dict
 
-    else:
-        return str(obj)
+def _finish_tuple(stack, node, parent, key):
+    parent[key] = tuple(node.items)
+
+
+_CONTAINER_HANDLERS = {
+    dict: _expand_dict,
+    list: _expand_list,
+    tuple: _expand_tuple,
+    _TupleItems: _finish_tuple,
+}
+
+
+def _container_handler(node):
+    handler = _CONTAINER_HANDLERS.get(type(node))
+    if handler is None and isinstance(node, (dict, list, tuple)):
+        # subclasses (OrderedDict, namedtuple, ...) miss the exact type lookup
+        handler = next(
+            h for cls, h in _CONTAINER_HANDLERS.items() if isinstance(node, cls)
+        )
+    return handler
+
+
+def sample_tune_space(obj):
+    root = [None]
+    stack = [(obj, root, 0)]
+    while stack:
+        node, parent, key = stack.pop()
+        handler = _container_handler(node)
+        if handler is not None:
+            handler(stack, node, parent, key)
+
+        elif isinstance(node, Categorical):
+            stack.append((node.sample(), parent, key))
+
+        elif isinstance(node, Domain):
+            parent[key] = node.sample()
+
+        else:
+            parent[key] = node
+
+    return root[0]
+
+
+def traverse_nested_tune_space(obj, func=lambda x: print(x)):
+    descs = {}
+    root = [None]
+    stack = [(obj, root, 0)]
+    while stack:
+        node, parent, key = stack.pop()
+        handler = _container_handler(node)
+        if handler is not None:
+            handler(stack, node, parent, key)
+
+        elif isinstance(node, Categorical):
+            categories = [None] * len(node)
+            parent[key] = {"sampler": "tune.choice", "categories": categories}
+            _push_children(stack, enumerate(node), categories)
+
+        # a domain (other than Categorical)
+        elif isinstance(node, Domain):
+            # the same domain object is often shared by several keys
+            if id(node) not in descs:
+                descs[id(node)] = describe_as_dict(node)
+            parent[key] = dict(descs[id(node)])
+
+        else:
+            parent[key] = str(node)
+
+    return root[0]
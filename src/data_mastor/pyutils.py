@@ -2,15 +2,14 @@
 
 
 def prefix_dict_keys(d, prefix):
-    new_d = {}
-    for key, val in d.items():
-        if isinstance(key, str):
-            new_key = prefix + key
-            new_d[new_key] = val
-        else:
-            new_d[key] = val
+    return {
+        (prefix + key if isinstance(key, str) else key): val for key, val in d.items()
+    }
 
-    return new_d
+
+def prefix_str_dict_keys(d, prefix):
+    # all keys must be str, e.g. mlflow metrics/params/tags dicts
+    return {prefix + key: val for key, val in d.items()}
 
 
 # misc
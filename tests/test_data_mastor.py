@@ -1,10 +1,15 @@
 from __future__ import annotations
 
+from collections import OrderedDict, namedtuple
 from functools import partial
 from math import isclose
+from types import SimpleNamespace
 
+import numpy as np
 import pandas as pd
 import pytest
+from mlflow.utils.mlflow_tags import MLFLOW_PARENT_RUN_ID, MLFLOW_RUN_NAME
+from ray import tune
 from sklearn.datasets import load_digits
 
 from data_mastor import __version__
@@ -47,6 +52,285 @@ def test_subset_indices(digits):
     assert False not in are_close
 
 
+def test_subset_indices_custom_stratify(digits):
+    labels = (digits["target"] % 2).to_numpy()
+    indices = ms.subset_indices(digits["target"], ratio=0.2, stratify=labels)
+
+    assert len(indices) == 360
+    assert isclose(labels[indices].mean(), labels.mean(), abs_tol=0.01)
+
+
+def test_subset_indices_unstratified(digits):
+    indices = ms.subset_indices(digits["target"], ratio=0.2, stratify=False)
+
+    assert isinstance(indices, list)
+    assert len(indices) == len(set(indices)) == 360
+    assert 0 <= min(indices) and max(indices) < len(digits)
+
+    # an int ratio is a number of rows, as in train_test_split
+    assert len(ms.subset_indices(digits["target"], ratio=10, stratify=False)) == 10
+    assert len(ms.subset_indices(digits["target"], ratio=10)) == 10
+
+    # extra train_test_split arguments are forwarded
+    indices = ms.subset_indices(
+        digits["target"], ratio=10, stratify=False, shuffle=False
+    )
+    assert indices == list(range(len(digits) - 10, len(digits)))
+
+    # sklearn-style seeds work with and without the train_test_split fallback
+    for kwargs in ({}, {"shuffle": True}):
+        indices = ms.subset_indices(
+            digits["target"],
+            ratio=0.2,
+            random_state=np.random.RandomState(0),
+            stratify=False,
+            **kwargs,
+        )
+        assert len(indices) == 360
+
+
+def test_data_subsets(digits):
+    X, y = digits.drop(columns="target"), digits["target"]
+    data = ms.data_subsets(
+        X, y, train_ratio=0.6, test_ratio=0.2, val_ratio=0.2, random_state=0
+    )
+
+    indices = [data[f"y_{s}"].index for s in ("train", "test", "val")]
+    assert sum(map(len, indices)) == len(digits)
+    assert len(set().union(*indices)) == len(digits)
+    assert isclose(len(data["X_train"]) / len(digits), 0.6, abs_tol=0.01)
+    assert (data["X_test"].index == data["y_test"].index).all()
+
+    vc = y.value_counts() / len(y)
+    vc_val = data["y_val"].value_counts() / len(data["y_val"])
+    assert ((vc - vc_val).abs() < 0.05).all()
+
+
+@pytest.mark.parametrize(
+    "class_size, num_classes, ratios, sizes",
+    [
+        (3, 10, (0.6, 0.2, 0.2), (18, 6, 6)),
+        (7, 20, (0.6, 0.2, 0.2), (84, 28, 28)),
+        (5, 4, (0.7, 0.3, None), (14, 6)),
+    ],
+)
+def test_data_subsets_small_classes(class_size, num_classes, ratios, sizes):
+    y = np.repeat(np.arange(num_classes), class_size)
+    X = np.arange(len(y))
+    data = ms.data_subsets(X, y, *ratios, random_state=0)
+
+    subsets = [data[f"y_{s}"] for s in ("train", "test", "val")[: len(sizes)]]
+    assert tuple(map(len, subsets)) == sizes
+    assert sorted(np.concatenate(subsets)) == sorted(y)
+    # every class is spread over the subsets as evenly as possible
+    for subset, size in zip(subsets, sizes):
+        counts = np.bincount(subset, minlength=num_classes)
+        assert counts.max() - counts.min() <= 1
+        assert counts.sum() == size
+
+
+def test_data_subsets_random_state():
+    y = np.repeat(np.arange(3), 10)
+    X = np.arange(len(y))
+    data = ms.data_subsets(X, y, 0.6, 0.2, 0.2, random_state=np.random.RandomState(0))
+    same = ms.data_subsets(X, y, 0.6, 0.2, 0.2, random_state=np.random.RandomState(0))
+
+    for key in data:
+        assert (data[key] == same[key]).all()
+
+
+def test_data_subsets_empty_subset():
+    with pytest.raises(ValueError, match="test subset would be empty"):
+        ms.data_subsets(np.arange(4), np.array([0, 0, 1, 1]), 0.9, 0.1)
+
+
+def test_data_subsets_ratio_fractions():
+    with pytest.raises(ValueError, match="must be fractions"):
+        ms.data_subsets(np.arange(4), np.array([0, 0, 1, 1]), 2, 1)
+
+
+@pytest.fixture
+def search_runs(monkeypatch):
+    runs = pd.DataFrame(
+        {
+            "run_id": ["r0", "r1", "r2", "r3", "r4", "r5"],
+            f"tags.{MLFLOW_RUN_NAME}": [
+                "summary",
+                "trial.1",
+                "trial_2",
+                "trial_3",
+                "trial_4",
+                None,
+            ],
+            f"tags.{MLFLOW_PARENT_RUN_ID}": [None, None, None, "r0", None, None],
+            f"tags.{ms.MLFLOW_RUNGROUP_TAGNAME}": [None, "a", "b", "b", "b", "c"],
+        }
+    )
+    monkeypatch.setattr(ms.mlflow, "search_runs", lambda **kwargs: runs)
+    return runs
+
+
+def test_find_runs(search_runs):
+    def run_ids(**kwargs):
+        return ms.find_runs(**kwargs)["run_id"].tolist()
+
+    assert run_ids() == search_runs["run_id"].tolist()
+    assert run_ids(run_name_contains="trial_") == ["r2", "r3", "r4"]
+    assert run_ids(run_name_contains=r"trial\.") == ["r1"]
+    assert run_ids(run_name_contains="trial_[24]") == ["r2", "r4"]
+    assert run_ids(exclude_child_runs=True) == ["r0", "r1", "r2", "r4", "r5"]
+    # runs without a rungroup tag are ignored when picking the latest group
+    assert run_ids(in_latest_run_group=True) == ["r5"]
+    assert run_ids(
+        run_name_contains="trial",
+        exclude_child_runs=True,
+        in_latest_run_group=True,
+    ) == ["r2", "r4"]
+    assert run_ids(run_name_contains="summary", in_latest_run_group=True) == []
+
+
+class FakeMlflowClient:
+    def __init__(self, runs):
+        self.runs = runs
+        self.batches = {}
+
+    def get_run(self, run_id):
+        return self.runs[run_id]
+
+    def log_batch(self, run_id, metrics=(), params=(), tags=()):
+        assert run_id not in self.batches
+        self.batches[run_id] = (metrics, params, tags)
+
+    def set_tag(self, run_id, key, value):
+        if run_id == "broken":
+            raise RuntimeError("set_tag failed")
+        self.runs[run_id].data.tags[key] = value
+
+
+def fake_run(metrics=None, params=None, tags=None):
+    return SimpleNamespace(
+        data=SimpleNamespace(
+            metrics=metrics or {}, params=params or {}, tags=tags or {}
+        )
+    )
+
+
+@pytest.fixture
+def mlflow_client(monkeypatch):
+    runs = {
+        f"cback{i}": fake_run(
+            metrics={"acc": i / 10},
+            params={"lr": str(i)},
+            tags={
+                ms.MLFLOW_RUNGROUP_TAGNAME: "g1",
+                "trial_name": f"trial_{i}",
+                MLFLOW_RUN_NAME: f"trial_{i}",
+                ms.MLFLOW_LOGGER_TAGNAME: ms.RAY_MLFLOW_CALLBACK_LOGGER,
+                "other": "not copied",
+            },
+        )
+        for i in range(3)
+    }
+    client = FakeMlflowClient(runs)
+    monkeypatch.setattr(ms, "MlflowClient", lambda: client)
+    return client
+
+
+def test_assimilate_ray_runs(mlflow_client):
+    found_runs = pd.DataFrame(
+        {
+            "run_id": ["mixin0", "mixin1", "mixin2", "cback0", "cback1", "cback2"],
+            f"tags.{ms.MLFLOW_LOGGER_TAGNAME}": [ms.RAY_MLFLOW_MIXIN_LOGGER] * 3
+            + [ms.RAY_MLFLOW_CALLBACK_LOGGER] * 3,
+        }
+    )
+    mixin_run_ids, cback_run_ids = ms.assimilate_ray_runs(found_runs)
+
+    assert mixin_run_ids == ["mixin0", "mixin1", "mixin2"]
+    assert cback_run_ids == ["cback0", "cback1", "cback2"]
+    assert mlflow_client.batches.keys() == set(mixin_run_ids)
+    for i in range(3):
+        metrics, params, tags = mlflow_client.batches[f"mixin{i}"]
+        assert [(m.key, m.value, m.step) for m in metrics] == [("ray_acc", i / 10, 0)]
+        assert [(p.key, p.value) for p in params] == [("ray_conf_lr", str(i))]
+        assert {t.key: t.value for t in tags} == {
+            ms.MLFLOW_RUNGROUP_TAGNAME: "g1",
+            "trial_name": f"trial_{i}",
+            MLFLOW_RUN_NAME: f"trial_{i}",
+            ms.MLFLOW_LOGGER_TAGNAME: "data-mastor-combine",
+        }
+
+
+def test_adopt_runs(mlflow_client):
+    children = [f"child{i}" for i in range(20)]
+    mlflow_client.runs.update({run_id: fake_run() for run_id in children})
+    ms.adopt_runs(children, "parent")
+
+    for run_id in children:
+        assert mlflow_client.runs[run_id].data.tags == {MLFLOW_PARENT_RUN_ID: "parent"}
+
+    # an error in a worker thread surfaces from adopt_runs
+    with pytest.raises(RuntimeError, match="set_tag failed"):
+        ms.adopt_runs(["child0", "broken", "child1"], "parent")
+
+
+Pair = namedtuple("Pair", "x y")
+
+
+@pytest.fixture
+def tune_space():
+    shared = tune.uniform(0, 1)
+    space = {
+        "a": shared,
+        "b": [1, (2, shared), [], ()],
+        "c": tune.choice([tune.choice(["x", "y"])]),
+        "d": OrderedDict(e=tune.randint(0, 10), f={}),
+        "g": Pair(shared, "s"),
+    }
+    return space
+
+
+def test_sample_tune_space(tune_space):
+    space = tune_space
+    for seed in range(5):
+        # sample the domains directly, in the order they appear in the space
+        np.random.seed(seed)
+        expected = {
+            "a": space["a"].sample(),
+            "b": [1, (2, space["a"].sample()), [], ()],
+            "c": space["c"].sample().sample(),
+            "d": {"e": space["d"]["e"].sample(), "f": {}},
+            "g": (space["a"].sample(), "s"),
+        }
+
+        np.random.seed(seed)
+        sample = ms.sample_tune_space(space)
+        assert sample == expected
+        # container subclasses come back as the plain container
+        assert type(sample["d"]) is dict
+        assert type(sample["g"]) is tuple
+
+
+def test_traverse_nested_tune_space(tune_space):
+    uniform = {"sampler": "Uniform", "domain": "(0, 1)"}
+    desc = ms.traverse_nested_tune_space(tune_space)
+
+    assert desc == {
+        "a": uniform,
+        "b": ["1", ("2", uniform), [], ()],
+        "c": {
+            "sampler": "tune.choice",
+            "categories": [{"sampler": "tune.choice", "categories": ["x", "y"]}],
+        },
+        "d": {"e": {"sampler": "Uniform", "domain": "(0, 10)"}, "f": {}},
+        "g": (uniform, "s"),
+    }
+    assert type(desc["d"]) is dict
+    assert type(desc["g"]) is tuple
+    # the shared domain is described once but not aliased in the output
+    assert desc["a"] is not desc["b"][1][1]
+
+
 if __name__ == "__main__":
     print("Name:", __name__)
     df = load_data()
@@ -0,0 +1,8 @@
+from __future__ import annotations
+
+from data_mastor import pyutils as pu
+
+
+def test_prefix_dict_keys():
+    assert pu.prefix_dict_keys({"a": 1, 2: "b"}, "x_") == {"x_a": 1, 2: "b"}
+    assert pu.prefix_str_dict_keys({"a": 1, "b": 2}, "x_") == {"x_a": 1, "x_b": 2}